@@ -1,27 +1,112 @@
+import copy
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from pathlib import Path
+
 import streamlit as st
+import numpy as np
 import pandas as pd
 import folium
-from folium.plugins import MarkerCluster
+import pydeck as pdk
+from folium.plugins import FastMarkerCluster
 from streamlit_folium import st_folium
 
 # --- optional: friendly guard if geopy missing ---
 try:
     from geopy.geocoders import Nominatim
     from geopy.extra.rate_limiter import RateLimiter
+    from geopy.adapters import RequestsAdapter
     GEO_AVAILABLE = True
 except Exception:
     GEO_AVAILABLE = False
 
+# --- optional: Rust-based xlsx reader (much faster than openpyxl) ---
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except Exception:
+    EXCEL_ENGINE = None  # pandas default (openpyxl)
+
 st.set_page_config(layout="wide")
 st.title("🌍 Cocoa Supply Chain Actors Map")
 st.write("Real geographic map of cocoa companies with interactive colored markers by role.")
 
 # --- Load Excel data ---
-@st.cache_data
-def load_data():
-    return pd.read_excel("cocoa_supply_chain (2).xlsx")
+DATA_PATH = Path("cocoa_supply_chain (2).xlsx")
+# Parquet sidecar of the parsed workbook, reused until the .xlsx is modified.
+# Bump the version whenever read_workbook's transforms change, so stale sidecars are rebuilt.
+PARQUET_VERSION = 2  # 2: text columns stored as Arrow-backed strings
+PARQUET_PATH = DATA_PATH.with_name(f"{DATA_PATH.stem}.v{PARQUET_VERSION}.parquet")
+
+def read_workbook():
+    if PARQUET_PATH.exists() and PARQUET_PATH.stat().st_mtime >= DATA_PATH.stat().st_mtime:
+        return pd.read_parquet(PARQUET_PATH)
+
+    df = pd.read_excel(DATA_PATH, engine=EXCEL_ENGINE)
+    # Low-cardinality text columns become categoricals so filters compare int codes
+    for col in ["Role", "Country", "Company"]:
+        if col in df.columns:
+            df[col] = df[col].astype("string").str.strip().astype("category")
+    # Remaining text columns (and ones mixing numbers and text, which parquet can't
+    # store as-is) become Arrow-backed strings; st.dataframe ships Arrow directly
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            continue
+        kind = pd.api.types.infer_dtype(df[col], skipna=True)
+        if kind in ("string", "mixed", "mixed-integer", "mixed-integer-float"):
+            df[col] = df[col].astype("string[pyarrow]")
+
+    tmp_path = PARQUET_PATH.with_suffix(".parquet.tmp")
+    try:
+        df.to_parquet(tmp_path)
+        tmp_path.replace(PARQUET_PATH)
+    except OSError:
+        # Read-only or unwritable directory: keep serving from the workbook
+        tmp_path.unlink(missing_ok=True)
+    return df
+
+# --- Role to color mapping ---
+role_colors = {
+    "Exporter/Trader": "blue",
+    "Processor/Manufacturer": "red",
+    "Support & Services": "green",
+    "N/A": "gray",
+}
+# RGBA equivalents of the marker colors, for the pydeck map
+marker_rgba = {
+    "blue": [31, 119, 180, 200],
+    "red": [214, 39, 40, 200],
+    "green": [44, 160, 44, 200],
+    "gray": [127, 127, 127, 200],
+}
 
-df = load_data()
+# Shared read-only across sessions (no pickle round-trip per rerun); callers copy before mutating
+@st.cache_resource
+def load_data():
+    df = read_workbook()
+
+    # Styling and display columns depend only on source columns, so they are derived once here
+    if "Role" in df.columns:
+        # One color per Role category plus a trailing "gray" that code -1 (missing) indexes;
+        # rows then pick theirs by fancy indexing on the category codes
+        codes = df["Role"].cat.codes.to_numpy()
+        color_names = np.array([role_colors.get(r, "gray") for r in df["Role"].cat.categories] + ["gray"])
+        df["MarkerColor"] = pd.Categorical(color_names[codes])
+        # pydeck fill color as uint8 R/G/B/A columns rather than a Python list per row
+        rgba = np.array([marker_rgba[c] for c in color_names], dtype=np.uint8)[codes]
+        df[["R", "G", "B", "A"]] = rgba
+    if "Volume (tons/year)" in df.columns:
+        # Parsed once here; float32 is exact for whole tonnages up to ~16 million
+        df["Volume (tons/year)"] = volume = pd.to_numeric(df["Volume (tons/year)"], errors="coerce").astype("float32")
+        # Display string for popups, tooltips and the table ("" when unknown)
+        df["Volume (formatted)"] = volume.fillna(0).astype("int64").map("{:,}".format).where(volume.notna(), "")
+        # pydeck radius in meters; area grows with volume, unknown or negative volumes get the base size
+        df["Radius"] = (15_000 + 60 * np.sqrt(volume.clip(lower=0).fillna(0))).round().astype("int32")
+    return df
+
+df = load_data().copy()
 
 # --- Validate required columns ---
 required_cols = {"Company", "Role", "Country", "City"}
@@ -31,34 +116,83 @@ if missing:
     st.stop()
 
 # --- Build a location string from City + Country ---
-df["City"] = df["City"].astype(str).str.strip()
-df["Country"] = df["Country"].astype(str).str.strip()
-df["location_str"] = (df["City"] + ", " + df["Country"]).str.replace(r"^,\s*|,\s*$", "", regex=True)
+# A blank City leaves ", Country", which the regex below trims to just the country
+df["City"] = df["City"].fillna("").astype("string[pyarrow]").str.strip()
+df["location_str"] = (df["City"] + ", " + df["Country"].astype(str)).str.replace(r"^,\s*|,\s*$", "", regex=True)
 
 # --- Geocoder (cached resource) ---
+# Requests overlap in a small thread pool over one pooled HTTP session; the
+# (thread-safe) RateLimiter still spaces their start times to Nominatim's 1 req/s.
+GEOCODE_WORKERS = 4
+
 @st.cache_resource
 def get_geocoder():
-    geolocator = Nominatim(user_agent="cocoa-map-app", timeout=10)
+    geolocator = Nominatim(
+        user_agent="cocoa-map-app",
+        timeout=10,
+        adapter_factory=partial(
+            RequestsAdapter, pool_connections=GEOCODE_WORKERS, pool_maxsize=GEOCODE_WORKERS
+        ),
+    )
     return RateLimiter(geolocator.geocode, min_delay_seconds=1)
 
+# --- Persistent geocode cache (survives restarts and redeploys) ---
+GEOCODE_CACHE_PATH = "geocode_cache.sqlite"
+
+@st.cache_resource
+def get_geocode_cache():
+    conn = sqlite3.connect(GEOCODE_CACHE_PATH, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS geocode_cache "
+        "(location TEXT PRIMARY KEY, lat REAL, lon REAL)"
+    )
+    return conn
+
+def read_cached_locations(conn, locations, chunk_size=500):
+    """Return {location: (lat, lon)} for the locations already stored on disk."""
+    cached = {}
+    for i in range(0, len(locations), chunk_size):
+        chunk = locations[i:i + chunk_size]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(
+            f"SELECT location, lat, lon FROM geocode_cache WHERE location IN ({placeholders})",
+            chunk,
+        )
+        cached.update({loc: (lat, lon) for loc, lat, lon in rows})
+    return cached
+
 # --- Geocode helper (cache results for the session) ---
 @st.cache_data
 def geocode_locations(unique_locations):
     """Return a dict {location_str: (lat, lon)} for the given unique list."""
-    results = {}
     if not GEO_AVAILABLE:
         return {loc: (None, None) for loc in unique_locations}
 
+    conn = get_geocode_cache()
+    results = read_cached_locations(conn, unique_locations)
+
     geocode = get_geocoder()
-    for loc in unique_locations:
+
+    def safe_geocode(loc):
         try:
             hit = geocode(loc)
-            if hit:
-                results[loc] = (hit.latitude, hit.longitude)
-            else:
-                results[loc] = (None, None)
         except Exception:
-            results[loc] = (None, None)
+            return (None, None)
+        return (hit.latitude, hit.longitude) if hit else (None, None)
+
+    misses = [loc for loc in unique_locations if loc not in results]
+    with ThreadPoolExecutor(max_workers=GEOCODE_WORKERS) as ex:
+        fetched = dict(zip(misses, ex.map(safe_geocode, misses)))
+    results.update(fetched)
+    new_hits = [(loc, lat, lon) for loc, (lat, lon) in fetched.items() if lat is not None]
+
+    # Only successful lookups are persisted, so misses are retried after a restart
+    if new_hits:
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO geocode_cache (location, lat, lon) VALUES (?, ?, ?)",
+                new_hits,
+            )
     return results
 
 # --- Sidebar: Geocoding control ---
@@ -79,9 +213,14 @@ else:
     # the call is instant; otherwise coordinates will be None.
     lookup = geocode_locations(df["location_str"].dropna().unique().tolist())
 
-# Map coordinates back
-df["Latitude"]  = df["location_str"].map(lambda x: lookup.get(x, (None, None))[0])
-df["Longitude"] = df["location_str"].map(lambda x: lookup.get(x, (None, None))[1])
+# Broadcast coordinates back with one hashmap lookup per row and column
+places = list(lookup)
+latlon = np.array([lookup[p] for p in places], dtype="float64").reshape(-1, 2)
+lat_map = dict(zip(places, latlon[:, 0]))
+lon_map = dict(zip(places, latlon[:, 1]))
+# float32 (~7 significant digits) is plenty for map markers at half the bytes
+df["Latitude"] = df["location_str"].map(lat_map).astype("float32")
+df["Longitude"] = df["location_str"].map(lon_map).astype("float32")
 
 # Drop rows where we couldn’t geocode
 df = df.dropna(subset=["Latitude", "Longitude"]).copy()
@@ -91,50 +230,45 @@ if df.empty:
 
 # --- Normalize "Customer Y/N" to Yes/No (blank -> No) ---
 if "Customer (Y/N)" in df.columns:
-    raw = df["Customer (Y/N)"]
-    df["Customer"] = (
-        raw.fillna("")
-           .astype(str).str.strip().str.lower()
-           .replace({"": "no", "nan": "no"})
-           .map({
-               "y": "Yes", "yes": "Yes", "1": "Yes", "true": "Yes",
-               "n": "No", "no": "No", "0": "No", "false": "No"
-           })
-           .fillna("No")
-    )
+    # Anything that isn't an explicit yes (blank, "n", "0", typos…) counts as No.
+    # Only the few distinct answers are normalized; rows reuse them through their codes.
+    codes, answers = pd.factorize(df["Customer (Y/N)"])
+    is_yes = answers.astype(str).str.strip().str.lower().isin(["y", "yes", "1", "true"])
+    is_yes = np.append(is_yes, False)  # code -1 (missing) lands on this last slot
+    df["Customer"] = pd.Categorical.from_codes(np.where(is_yes[codes], 0, 1), categories=["Yes", "No"])
 else:
     if "Customer" not in df.columns:
         df["Customer"] = "No"
-
-# --- Role to color mapping ---
-role_colors = {
-    "Exporter/Trader": "blue",
-    "Processor/Manufacturer": "red",
-    "Support & Services": "green",
-    "N/A": "gray",
-}
-df["MarkerColor"] = df["Role"].apply(lambda r: role_colors.get(str(r), "gray"))
+    # Same categorical dtype as the normalized column, for the code-based filter/groupby paths
+    df["Customer"] = df["Customer"].astype("category")
 
 # --- Sidebar Filters ---
 st.sidebar.header("🔍 Filter Companies")
 
-# Ensure volume numeric
-df["Volume (tons/year)"] = pd.to_numeric(df.get("Volume (tons/year)"), errors='coerce')
+@st.cache_data
+def sidebar_options(df):
+    """Sorted unique values for the multiselect filters, computed once per dataset."""
+    return {
+        col: sorted(df[col].dropna().astype(str).unique())
+        for col in ["Role", "Country", "Company"]
+    }
+
+options = sidebar_options(df[["Role", "Country", "Company"]])
 
 # Role filter
-available_roles = sorted(df["Role"].dropna().astype(str).unique())
+available_roles = options["Role"]
 role_options = ["All"] + available_roles
 selected_roles = st.sidebar.multiselect("Select Role(s)", role_options, default=["All"])
 filtered_roles = available_roles if "All" in selected_roles or not selected_roles else selected_roles
 
 # Country filter
-available_countries = sorted(df["Country"].dropna().astype(str).unique())
+available_countries = options["Country"]
 country_options = ["All"] + available_countries
 selected_countries = st.sidebar.multiselect("Select Country(s)", country_options, default=["All"])
 filtered_countries = available_countries if "All" in selected_countries or not selected_countries else selected_countries
 
 # Company filter
-available_companies = sorted(df["Company"].dropna().astype(str).unique())
+available_companies = options["Company"]
 company_options = ["All"] + available_companies
 selected_companies = st.sidebar.multiselect("Select Company(s)", company_options, default=["All"])
 filtered_companies = available_companies if "All" in selected_companies or not selected_companies else selected_companies
@@ -151,22 +285,55 @@ volume_threshold = st.sidebar.slider("Minimum Volume (tons/year)",
                                      int(vmin), int(vmax), value=int(vmin), step=10_000)
 
 # Apply filters
-filtered_df = df[
-    (df["Role"].astype(str).isin(filtered_roles)) &
-    (df["Country"].astype(str).isin(filtered_countries)) &
-    (df["Company"].astype(str).isin(filtered_companies)) &
-    ((df["Volume (tons/year)"].isna()) | (df["Volume (tons/year)"] >= volume_threshold))
-].copy()
-
+def category_mask(col, selected):
+    """Boolean mask of rows whose categorical value is in `selected`, compared on codes."""
+    codes = col.cat.categories.get_indexer(selected)
+    return np.isin(col.cat.codes.to_numpy(), codes[codes >= 0])
+
+# An "All" selection matches every option, which only excludes blank values (code -1),
+# so its term is a plain code check instead of an isin; the slider at its minimum is skipped
+mask = np.ones(len(df), dtype=bool)
+for col, selected, chosen in [
+    ("Role", selected_roles, filtered_roles),
+    ("Country", selected_countries, filtered_countries),
+    ("Company", selected_companies, filtered_companies),
+]:
+    if selected and "All" not in selected:
+        mask &= category_mask(df[col], chosen)
+    else:
+        mask &= df[col].cat.codes.to_numpy() >= 0
+if volume_threshold > vmin:
+    mask &= ((df["Volume (tons/year)"].isna()) | (df["Volume (tons/year)"] >= volume_threshold)).to_numpy()
 if customer_choice != "All":
-    filtered_df = filtered_df[filtered_df["Customer"] == customer_choice].copy()
+    mask &= (df["Customer"] == customer_choice).to_numpy()
+
+# One selection with the combined mask, so the frame is materialized only once
+filtered_df = df.loc[mask]
 
 if filtered_df.empty:
     st.info("No results for the selected filters.")
     st.stop()
 
-# --- Create Folium map centered on cocoa belt ---
-m = folium.Map(location=[10, 0], zoom_start=2, tiles="CartoDB Positron")
+# Identifies the filtered result in the caches below without hashing the frame
+filter_key = (
+    len(df), tuple(selected_roles), tuple(selected_countries), tuple(selected_companies),
+    customer_choice, volume_threshold,
+)
+
+# --- Map renderer ---
+st.sidebar.markdown("### 🗺️ Map")
+show_fast_map = st.sidebar.toggle(
+    "Fast map (pydeck)", value=True,
+    help="Draws points with WebGL. Turn off for the Leaflet map with clustering, click popups and the legend.",
+)
+
+def as_arrow_text(col):
+    """Arrow-backed string copy of `col`, with missing values as empty strings."""
+    return col.astype("string[pyarrow]").fillna("")
+
+def json_coords(col):
+    """float32 coordinates as float64 rounded to ~1 m, so they serialize to short JSON numbers."""
+    return col.astype("float64").round(5)
 
 # --- Legend ---
 legend_html = '''
@@ -182,93 +349,298 @@ legend_html = '''
      <i style="color: gray;">●</i> N/A
  </div>
 '''
-m.get_root().html.add_child(folium.Element(legend_html))
-
-# --- Marker cluster ---
-marker_cluster = MarkerCluster().add_to(m)
 
-for _, row in filtered_df.iterrows():
-    try:
-        volume_formatted = f"{int(row['Volume (tons/year)']):,}"
-    except Exception:
-        volume_formatted = row['Volume (tons/year)']
-
-    popup_html = f"""
-    <b>{row['Company']}</b><br>
-    Role: {row['Role']}<br>
-    Location: {row['City']}, {row['Country']}<br>
-    Volume: {volume_formatted} tons<br>
-    Customer: {row['Customer']}<br>
-    Email: {row.get('Contact Email', '')}
-    """
+# --- Base Folium map centered on cocoa belt (tiles + legend never change) ---
+@st.cache_resource
+def base_map():
+    m = folium.Map(location=[10, 0], zoom_start=2, tiles="CartoDB Positron", prefer_canvas=True)
+    m.get_root().html.add_child(folium.Element(legend_html))
+    return m
+
+def popup_fields(df):
+    """Text shown in each marker popup, as Arrow strings with blanks for missing values."""
+    def text(col):
+        if col not in df.columns:
+            return pd.Series("", index=df.index, dtype="string[pyarrow]")
+        return as_arrow_text(df[col])
+
+    return pd.DataFrame({
+        "Company": text("Company"),
+        "Role": text("Role"),
+        "Location": text("City") + ", " + text("Country"),
+        "Volume": text("Volume (formatted)"),
+        "Customer": text("Customer"),
+        "Email": text("Contact Email"),
+    })
+
+def build_popups(df):
+    """Popup HTML for every row, built in one vectorized pass on Arrow strings."""
+    fields = popup_fields(df)
+    return (
+        "<b>" + fields["Company"] + "</b><br>"
+        + "Role: " + fields["Role"] + "<br>"
+        + "Location: " + fields["Location"] + "<br>"
+        + "Volume: " + fields["Volume"] + " tons<br>"
+        + "Customer: " + fields["Customer"] + "<br>"
+        + "Email: " + fields["Email"]
+    ).to_numpy()
+
+# FastMarkerCluster rows are [lat, lon, color, *popup_fields]. Only the field
+# values are shipped; the popup HTML is assembled in the browser when opened.
+MARKER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+        radius: 6, color: row[2], fillColor: row[2], fillOpacity: 0.8
+    });
+    marker.bindPopup(function () {
+        return "<b>" + row[3] + "</b><br>Role: " + row[4] + "<br>Location: " + row[5]
+            + "<br>Volume: " + row[6] + " tons<br>Customer: " + row[7] + "<br>Email: " + row[8];
+    });
+    return marker;
+}
+"""
 
-    folium.Marker(
-        location=[row["Latitude"], row["Longitude"]],
-        popup=popup_html,
-        icon=folium.Icon(color=row["MarkerColor"])
-    ).add_to(marker_cluster)
+@st.cache_data
+def build_map_html(_df, filter_key):
+    """Rendered HTML of the clustered Folium map for one filter selection.
 
-# --- Display map ---
-st_folium(m, use_container_width=True, height=600)
+    The frame is not hashed (leading underscore); `filter_key` identifies it.
+    """
+    m = copy.deepcopy(base_map())
+    marker_data = pd.concat(
+        [
+            json_coords(_df[["Latitude", "Longitude"]]),
+            _df["MarkerColor"].astype(str),
+            popup_fields(_df),
+        ],
+        axis=1,
+    ).to_numpy().tolist()
+    FastMarkerCluster(marker_data, callback=MARKER_CALLBACK).add_to(m)
+    return m.get_root().render()
+
+# --- Server-side clustering for very large result sets ---
+# Above this many points only per-cell cluster representatives for the current
+# view are sent to the browser, instead of every marker.
+SERVER_CLUSTER_MIN_POINTS = 3000
+# From this zoom on, only points sharing one exact coordinate are grouped
+MAX_CLUSTER_ZOOM = 16
+
+def grid_cluster(lats, lons, zoom, radius_px=60):
+    """Group points into `radius_px` cells of the Web Mercator pixel grid at `zoom`.
+
+    Returns (cluster_lats, cluster_lons, counts, members, same_spot), one entry
+    per occupied cell; `members` holds the indices of each cell's points and
+    `same_spot` flags cells whose points all share one coordinate.
+    """
+    if len(lats) == 0:
+        # Nothing in view (e.g. panned to open ocean)
+        return np.empty(0), np.empty(0), np.empty(0, dtype=np.int64), [], np.empty(0, dtype=bool)
+    if zoom >= MAX_CLUSTER_ZOOM:
+        keys = np.column_stack([lats, lons])
+    else:
+        n_cells = int(np.ceil(256 * 2 ** zoom / radius_px))
+        x = (lons + 180.0) / 360.0
+        sin_lat = np.sin(np.radians(np.clip(lats, -85.0511, 85.0511)))
+        y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)
+        cx = np.clip((x * n_cells).astype(np.int64), 0, n_cells - 1)
+        cy = np.clip((y * n_cells).astype(np.int64), 0, n_cells - 1)
+        keys = cx * n_cells + cy
+    _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    cluster_lats = np.bincount(inverse, weights=lats) / counts
+    cluster_lons = np.bincount(inverse, weights=lons) / counts
+
+    # Cell members as contiguous runs of one stable sort
+    order = np.argsort(inverse, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sorted_lats, sorted_lons = lats[order], lons[order]
+    same_spot = (
+        (np.maximum.reduceat(sorted_lats, starts) == np.minimum.reduceat(sorted_lats, starts))
+        & (np.maximum.reduceat(sorted_lons, starts) == np.minimum.reduceat(sorted_lons, starts))
+    )
+    members = np.split(order, starts[1:])
+    return cluster_lats, cluster_lons, counts, members, same_spot
+
+def in_view(lats, lons, bounds, pad=0.25):
+    """Mask of points inside the Leaflet `bounds` dict, padded by `pad` of its span."""
+    south, west = bounds["_southWest"]["lat"], bounds["_southWest"]["lng"]
+    north, east = bounds["_northEast"]["lat"], bounds["_northEast"]["lng"]
+    dlat, dlon = (north - south) * pad, (east - west) * pad
+    mask = (lats >= south - dlat) & (lats <= north + dlat)
+    if east - west + 2 * dlon < 360:
+        # Leaflet reports unwrapped longitudes (e.g. 170..200), so fold both edges
+        # into [-180, 180) and test across the antimeridian when they swap
+        west = (west - dlon + 180) % 360 - 180
+        east = (east + dlon + 180) % 360 - 180
+        if west <= east:
+            mask &= (lons >= west) & (lons <= east)
+        else:
+            mask &= (lons >= west) | (lons <= east)
+    return mask
+
+if show_fast_map:
+    # --- pydeck scatterplot (GPU-rendered, one instanced draw for all points) ---
+    deck_df = pd.DataFrame({
+        "Longitude": json_coords(filtered_df["Longitude"]),
+        "Latitude": json_coords(filtered_df["Latitude"]),
+        "R": filtered_df["R"],
+        "G": filtered_df["G"],
+        "B": filtered_df["B"],
+        "A": filtered_df["A"],
+        "Radius": filtered_df["Radius"],
+        "Company": filtered_df["Company"].astype(str),
+        "Role": filtered_df["Role"].astype(str),
+        "Location": filtered_df["City"].astype(str) + ", " + filtered_df["Country"].astype(str),
+        "Volume": filtered_df["Volume (formatted)"],
+        "Customer": filtered_df["Customer"].astype(str),
+    })
+    deck = pdk.Deck(
+        layers=[pdk.Layer(
+            "ScatterplotLayer",
+            data=deck_df,
+            get_position=["Longitude", "Latitude"],
+            get_fill_color="[R, G, B, A]",
+            get_radius="Radius",
+            radius_min_pixels=4,
+            pickable=True,
+        )],
+        initial_view_state=pdk.ViewState(latitude=10, longitude=0, zoom=1),
+        map_style="light",
+        tooltip={
+            "html": "<b>{Company}</b><br>Role: {Role}<br>Location: {Location}<br>"
+                    "Volume: {Volume} tons<br>Customer: {Customer}",
+        },
+    )
+    st.pydeck_chart(deck, width="stretch", height=600)
+else:
+    if len(filtered_df) >= SERVER_CLUSTER_MIN_POINTS:
+        # st_folium adds feature_group_to_add to the map it's given, so each rerun gets
+        # its own copy and the markers never leak into the shared skeleton
+        m = copy.deepcopy(base_map())
+
+        # Cluster on the server for the zoom/bounds the map reported on the last rerun
+        map_state = st.session_state.get("folium_map") or {}
+        zoom = map_state.get("zoom") or 2
+        center = map_state.get("center") or {"lat": 10, "lng": 0}
+        lats = filtered_df["Latitude"].to_numpy(dtype=float)
+        lons = filtered_df["Longitude"].to_numpy(dtype=float)
+        colors = filtered_df["MarkerColor"].to_numpy()
+        visible = np.flatnonzero(in_view(lats, lons, map_state["bounds"])) if map_state.get("bounds") else np.arange(len(lats))
+
+        cluster_lats, cluster_lons, counts, members, same_spot = grid_cluster(lats[visible], lons[visible], zoom)
+        first_rows = visible[[idx[0] for idx in members]]
+
+        # Companies geocoded to the same city share one coordinate and never split apart
+        # by zooming, so such a cell becomes one marker whose popup lists every member.
+        # Popup HTML is built only for those rows, in cell order.
+        spot_members = [idx for idx, spot in zip(members, same_spot) if spot]
+        spot_rows = visible[np.concatenate(spot_members)] if spot_members else []
+        popups = iter(build_popups(filtered_df.iloc[spot_rows]).tolist())
+
+        # Loop over plain Python lists pulled once, not per-element numpy scalars
+        clusters = folium.FeatureGroup(name="Companies")
+        for lat, lon, count, color, spot in zip(
+            cluster_lats.tolist(), cluster_lons.tolist(), counts.tolist(),
+            colors[first_rows].tolist(), same_spot.tolist(),
+        ):
+            if spot:
+                popup_html = "<hr>".join(islice(popups, count))
+                folium.CircleMarker(
+                    location=[lat, lon], radius=6 if count == 1 else 8 + 3 * np.log10(count),
+                    color=color, fill=True, fill_opacity=0.8,
+                    popup=folium.Popup(f'<div style="max-height:300px;overflow-y:auto">{popup_html}</div>', max_width=300),
+                    tooltip=f"{count:,} companies" if count > 1 else None,
+                ).add_to(clusters)
+            else:
+                folium.CircleMarker(
+                    location=[lat, lon], radius=8 + 3 * np.log10(count), color="#3186cc",
+                    fill=True, fill_opacity=0.6, tooltip=f"{count:,} companies – zoom in",
+                ).add_to(clusters)
+
+        # --- Display map (markers are swapped in without reloading the base map) ---
+        st_folium(
+            m, key="folium_map", feature_group_to_add=clusters,
+            zoom=zoom, center=(center["lat"], center["lng"]),
+            returned_objects=["zoom", "center", "bounds"],
+            use_container_width=True, height=600,
+        )
+    else:
+        # --- Display map (HTML cached per filter selection, embedded without st_folium) ---
+        # The session keeps the last HTML, so reruns from unrelated widgets skip even the cache lookup
+        if st.session_state.get("map_sig") != filter_key:
+            st.session_state.map_html = build_map_html(filtered_df, filter_key)
+            st.session_state.map_sig = filter_key
+        st.iframe(st.session_state.map_html, height=600)
 
 # --- Charts ---
 import plotly.express as px
 
 st.markdown("### 📊 Cocoa Supply Chain Analytics")
 
-filtered_df["Volume (tons/year)"] = pd.to_numeric(filtered_df["Volume (tons/year)"], errors='coerce')
+@st.cache_data
+def make_charts(_chart_df, filter_key):
+    """Build the analytics figures for one filter selection.
+
+    The frame itself is not hashed (leading underscore); `filter_key` identifies it.
+    """
+    # 1. Volume by Role
+    volume_by_role = (
+        _chart_df.groupby("Role", dropna=False, observed=True)["Volume (tons/year)"]
+        .sum(min_count=1)
+        .sort_values(ascending=False)
+        .reset_index()
+        .head(5)
+    )
+    fig_role = px.bar(
+        volume_by_role, x="Role", y="Volume (tons/year)",
+        title="Total Volume by Role",
+        labels={"Volume (tons/year)": "Volume (tons/year)", "Role": "Role"}
+    )
 
-# 1. Volume by Role
-volume_by_role = (
-    filtered_df.groupby("Role", dropna=False)["Volume (tons/year)"]
-    .sum(min_count=1)
-    .sort_values(ascending=False)
-    .reset_index()
-    .head(5)
-)
-fig_role = px.bar(
-    volume_by_role, x="Role", y="Volume (tons/year)",
-    title="Total Volume by Role",
-    labels={"Volume (tons/year)": "Volume (tons/year)", "Role": "Role"}
-)
-st.plotly_chart(fig_role, use_container_width=True)
-
-# 2. Volume by Country
-volume_by_country = (
-    filtered_df.groupby("Country", dropna=False)["Volume (tons/year)"]
-    .sum(min_count=1)
-    .sort_values(ascending=False)
-    .reset_index()
-)
-fig_country = px.pie(
-    volume_by_country, names="Country", values="Volume (tons/year)",
-    title="Volume Distribution by Country"
-)
-st.plotly_chart(fig_country, use_container_width=True)
-
-# 3. Top 10 Companies by Volume
-top_companies = (
-    filtered_df[["Company", "Volume (tons/year)"]]
-    .dropna()
-    .sort_values(by="Volume (tons/year)", ascending=False)
-    .head(10)
-)
-fig_top10 = px.bar(
-    top_companies, x="Company", y="Volume (tons/year)",
-    title="Top 10 Companies by Volume",
-    labels={"Volume (tons/year)": "Volume", "Company": "Company"},
-)
-st.plotly_chart(fig_top10, use_container_width=True)
+    # 2. Volume by Country
+    volume_by_country = (
+        _chart_df.groupby("Country", dropna=False, observed=True)["Volume (tons/year)"]
+        .sum(min_count=1)
+        .sort_values(ascending=False)
+        .reset_index()
+    )
+    fig_country = px.pie(
+        volume_by_country, names="Country", values="Volume (tons/year)",
+        title="Volume Distribution by Country"
+    )
+
+    # 3. Top 10 Companies by Volume
+    top_companies = (
+        _chart_df[["Company", "Volume (tons/year)"]]
+        .dropna()
+        .nlargest(10, "Volume (tons/year)")
+    )
+    fig_top10 = px.bar(
+        top_companies, x="Company", y="Volume (tons/year)",
+        title="Top 10 Companies by Volume",
+        labels={"Volume (tons/year)": "Volume", "Company": "Company"},
+    )
+
+    return fig_role, fig_country, fig_top10
+
+# Slim view with only the chart columns, so each aggregation scans just what it needs
+chart_df = filtered_df[["Role", "Country", "Company", "Volume (tons/year)"]]
+fig_role, fig_country, fig_top10 = make_charts(chart_df, filter_key)
+
+tab_role, tab_country, tab_top10 = st.tabs(["By Role", "By Country", "Top 10 Companies"])
+with tab_role:
+    st.plotly_chart(fig_role, width="stretch")
+with tab_country:
+    st.plotly_chart(fig_country, width="stretch")
+with tab_top10:
+    st.plotly_chart(fig_top10, width="stretch")
 
 # --- Table ---
 st.markdown("### 📋 List of Companies in the Cocoa Supply Chain")
-filtered_df["Volume (formatted)"] = filtered_df["Volume (tons/year)"].apply(
-    lambda x: f"{int(x):,}" if pd.notnull(x) and isinstance(x, (int, float)) else x
-)
 st.dataframe(
     filtered_df[[
         "Company", "Role", "Country", "City", "Customer", "Contact Email",
         "Volume (formatted)", "Latitude", "Longitude", "Notes"
     ]],
-    use_container_width=True
+    width="stretch"
 )